@@ -6,106 +6,113 @@ Adapted from the cmon driver by Matthew Hall
 
 """
 
-from __future__ import with_statement
-from __future__ import absolute_import
-from __future__ import print_function
+import logging
 import time
-import hashlib
+import functools
 import hmac
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    # orjson parses API responses faster, but is not required
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+import weedb
 import weewx
 import weewx.units
 from weewx.engine import StdService
 
 import weeutil.weeutil
 
-try:
-    # Test for new-style weewx logging by trying to import weeutil.logger
-    import weeutil.logger
-    import logging
+log = logging.getLogger(__name__)
 
-    log = logging.getLogger(__name__)
 
-    def logdbg(msg):
-        """Log debug messages"""
-        log.debug(msg)
+def logdbg(msg, *args):
+    """Log debug messages, only formatting them if debug is enabled"""
+    log.debug(msg, *args)
 
-    def loginf(msg):
-        """Log info messages"""
-        log.info(msg)
 
-    def logerr(msg):
-        """Log error messages"""
-        log.error(msg)
+def loginf(msg):
+    """Log info messages"""
+    log.info(msg)
 
 
-except ImportError:
-    # Old-style weewx logging
-    import syslog
-
-    def logmsg(level, msg):
-        """Log messages"""
-        syslog.syslog(level, "davishealthapi: %s:" % msg)
+def logerr(msg):
+    """Log error messages"""
+    log.error(msg)
 
-    def logdbg(msg):
-        """Log debug messages"""
-        logmsg(syslog.LOG_DEBUG, msg)
 
-    def loginf(msg):
-        """Log info messages"""
-        logmsg(syslog.LOG_INFO, msg)
+DRIVER_NAME = "DavisHealthAPI"
+DRIVER_VERSION = "0.10"
 
-    def logerr(msg):
-        """Log error messages"""
-        logmsg(syslog.LOG_ERR, msg)
+# How often to look for records older than max_age, in seconds
+PRUNE_INTERVAL = 3600
 
+# How often to fully rewrite the database file, in seconds. Between full
+# vacuums, each prune releases up to 1000 free pages with an incremental vacuum.
+VACUUM_INTERVAL = 86400
 
-DRIVER_NAME = "DavisHealthAPI"
-DRIVER_VERSION = "0.10"
+if weewx.__version__ < "4":
+    raise weewx.UnsupportedFeature(
+        "weewx 4 on Python 3 is required, found %s" % weewx.__version__
+    )
 
-if weewx.__version__ < "3":
-    raise weewx.UnsupportedFeature("weewx 3 is required, found %s" % weewx.__version__)
-
-weewx.units.USUnits["group_decibels"] = "decibels"
-weewx.units.MetricUnits["group_decibels"] = "decibels"
-weewx.units.MetricWXUnits["group_decibels"] = "decibels"
-weewx.units.default_unit_format_dict["decibels"] = "%.1f"
-weewx.units.default_unit_label_dict["decibels"] = " dBm"
-
-weewx.units.USUnits["group_millivolts"] = "millivolts"
-weewx.units.MetricUnits["group_millivolts"] = "millivolts"
-weewx.units.MetricWXUnits["group_millivolts"] = "millivolts"
-weewx.units.default_unit_format_dict["millivolts"] = "%d"
-weewx.units.default_unit_label_dict["millivolts"] = " mV"
-
-weewx.units.obs_group_dict["supercapVolt"] = "group_volt"
-weewx.units.obs_group_dict["solarVolt"] = "group_volt"
-weewx.units.obs_group_dict["txBattery"] = "group_volt"
-weewx.units.obs_group_dict["solarRadVolt"] = "group_volt"
-weewx.units.obs_group_dict["uvVolt"] = "group_volt"
-weewx.units.obs_group_dict["consoleBattery"] = "group_millivolts"
-weewx.units.obs_group_dict["consolePower"] = "group_millivolts"
-weewx.units.obs_group_dict["signalQuality"] = "group_percent"
-weewx.units.obs_group_dict["rssi"] = "group_decibels"
-weewx.units.obs_group_dict["uptime"] = "group_deltatime"
-weewx.units.obs_group_dict["linkUptime"] = "group_deltatime"
-weewx.units.obs_group_dict["packetStreak"] = "group_count"
-weewx.units.obs_group_dict["rainfallClicks"] = "group_count"
-weewx.units.obs_group_dict["errorPackets"] = "group_count"
-weewx.units.obs_group_dict["touchpadWakeups"] = "group_count"
-weewx.units.obs_group_dict["localAPIQueries"] = "group_count"
-weewx.units.obs_group_dict["txID"] = "group_count"
-weewx.units.obs_group_dict["txBatteryFlag"] = "group_count"
-weewx.units.obs_group_dict["firmwareVersion"] = "group_count"
-weewx.units.obs_group_dict["bootloaderVersion"] = "group_count"
-weewx.units.obs_group_dict["healthVersion"] = "group_count"
-weewx.units.obs_group_dict["radioVersion"] = "group_count"
-weewx.units.obs_group_dict["espressIFVersion"] = "group_count"
-weewx.units.obs_group_dict["resynchs"] = "group_count"
-weewx.units.obs_group_dict["rxBytes"] = "group_data"
-weewx.units.obs_group_dict["txBytes"] = "group_data"
-weewx.units.obs_group_dict["rapidRecords"] = "group_data"
+_UNIT_GROUPS = {
+    "group_decibels": "decibels",
+    "group_millivolts": "millivolts",
+}
+weewx.units.USUnits.update(_UNIT_GROUPS)
+weewx.units.MetricUnits.update(_UNIT_GROUPS)
+weewx.units.MetricWXUnits.update(_UNIT_GROUPS)
+weewx.units.default_unit_format_dict.update(
+    {
+        "decibels": "%.1f",
+        "millivolts": "%d",
+    }
+)
+weewx.units.default_unit_label_dict.update(
+    {
+        "decibels": " dBm",
+        "millivolts": " mV",
+    }
+)
+
+weewx.units.obs_group_dict.update(
+    {
+        "supercapVolt": "group_volt",
+        "solarVolt": "group_volt",
+        "txBattery": "group_volt",
+        "solarRadVolt": "group_volt",
+        "uvVolt": "group_volt",
+        "consoleBattery": "group_millivolts",
+        "consolePower": "group_millivolts",
+        "signalQuality": "group_percent",
+        "rssi": "group_decibels",
+        "uptime": "group_deltatime",
+        "linkUptime": "group_deltatime",
+        "packetStreak": "group_count",
+        "rainfallClicks": "group_count",
+        "errorPackets": "group_count",
+        "touchpadWakeups": "group_count",
+        "localAPIQueries": "group_count",
+        "txID": "group_count",
+        "txBatteryFlag": "group_count",
+        "firmwareVersion": "group_count",
+        "bootloaderVersion": "group_count",
+        "healthVersion": "group_count",
+        "radioVersion": "group_count",
+        "espressIFVersion": "group_count",
+        "resynchs": "group_count",
+        "rxBytes": "group_data",
+        "txBytes": "group_data",
+        "rapidRecords": "group_data",
+    }
+)
 
 schema = [
     ("dateTime", "INTEGER NOT NULL PRIMARY KEY"),  # seconds
@@ -141,30 +148,116 @@ schema = [
     ("txBytes", "INTEGER"),  # bytes
 ]
 
+# Column names of the schema, in order
+_SCHEMA_COLUMNS = tuple(column[0] for column in schema)
+
+# Packet fields and the historical API fields they are read from
+_HISTORICAL_FIELDS = (
+    ("rxCheckPercent", "reception"),
+    ("rssi", "rssi"),
+    ("supercapVolt", "supercap_volt_last"),
+    ("solarVolt", "solar_volt_last"),
+    ("packetStreak", "good_packets_streak"),
+    ("txID", "tx_id"),
+    ("txBattery", "trans_battery"),
+    ("rainfallClicks", "rainfall_clicks"),
+    ("solarRadVolt", "solar_rad_volt_last"),
+    ("txBatteryFlag", "trans_battery_flag"),
+    ("signalQuality", "reception"),
+    ("errorPackets", "error_packets"),
+    ("afc", "afc"),
+    ("resynchs", "resynchs"),
+    ("uvVolt", "uv_volt_last"),
+)
+
+# Packet fields and the current API fields they are read from
+_CURRENT_FIELDS = (
+    ("consoleBattery", "battery_voltage"),
+    ("rapidRecords", "rapid_records_sent"),
+    ("firmwareVersion", "firmware_version"),
+    ("uptime", "uptime"),
+    ("touchpadWakeups", "touchpad_wakeups"),
+    ("bootloaderVersion", "bootloader_version"),
+    ("localAPIQueries", "local_api_queries"),
+    ("rxBytes", "rx_bytes"),
+    ("healthVersion", "health_version"),
+    ("radioVersion", "radio_version"),
+    ("espressIFVersion", "espressif_version"),
+    ("linkUptime", "link_uptime"),
+    ("consolePower", "input_voltage"),
+    ("txBytes", "tx_bytes"),
+)
+
+# Data structure types that carry historical ISS health data, in order of
+# preference, and the type that carries current console health data
+_HISTORICAL_DATA_TYPES = (11, 13)
+_CURRENT_DATA_TYPE = 15
+
+
+# Keyed HMAC-SHA256 objects, one per API secret and signed prefix. Copying a
+# keyed object skips re-running the HMAC key schedule and re-absorbing the
+# prefix every time a signature is calculated.
+_hmac_templates = dict()
+
+
+def get_hmac(api_secret, prefix=""):
+    """Return a fresh HMAC-SHA256 object keyed with the API secret that has
+    already absorbed prefix"""
+
+    template = _hmac_templates.get((api_secret, prefix))
+    if template is None:
+        template = hmac.new(
+            api_secret.encode("utf-8"), prefix.encode("ascii"), "sha256"
+        )
+        _hmac_templates[(api_secret, prefix)] = template
+    return template.copy()
+
+
+# Parameters signed after the API key for each API call, in the alphabetical
+# order the WL API expects. The API key sorts first in every call.
+_HISTORICAL_PARAMETERS = ("end-timestamp", "start-timestamp", "station-id", "t")
+_CURRENT_PARAMETERS = ("station-id", "t")
+
+
+def get_signature(parameters, signed_keys, api_secret):
+    """Calculate the v2 API signature for a set of parameters"""
+
+    # Both the historical and current signatures can resume from the state
+    # after absorbing the API key
+    signature = get_hmac(api_secret, "api-key%s" % parameters["api-key"])
+    # Now feed in the remaining parameters. Hashing them one at a time gives
+    # the same digest as hashing their concatenation.
+    for key in signed_keys:
+        signature.update(("%s%s" % (key, parameters[key])).encode("ascii"))
+    return signature.hexdigest()
+
+
+@functools.lru_cache(maxsize=8)
+def get_base_url(endpoint, station_id, api_key):
+    """Return the part of a v2 API URL that stays the same between polls"""
+
+    # The timestamps and signature that follow never need escaping, but the
+    # configured station ID and API key are escaped to be safe
+    return "https://api.weatherlink.com/v2/%s/%s?%s" % (
+        endpoint,
+        quote(str(station_id), safe=""),
+        urlencode({"api-key": api_key}),
+    )
+
 
 def get_historical_url(parameters, api_secret):
     """Construct a valid v2 historical API URL"""
 
     # Get historical API data
-    # Now concatenate all parameters into a string
-    urltext = ""
-    for key in parameters:
-        urltext = urltext + key + str(parameters[key])
     # Now calculate the API signature using the API secret
-    api_signature = hmac.new(
-        api_secret.encode("utf-8"), urltext.encode("utf-8"), hashlib.sha256
-    ).hexdigest()
+    api_signature = get_signature(parameters, _HISTORICAL_PARAMETERS, api_secret)
     # Finally assemble the URL
-    apiurl = (
-        "https://api.weatherlink.com/v2/historic/%s?api-key=%s&start-timestamp=%s&end-timestamp=%s&api-signature=%s&t=%s"
-        % (
-            parameters["station-id"],
-            parameters["api-key"],
-            parameters["start-timestamp"],
-            parameters["end-timestamp"],
-            api_signature,
-            parameters["t"],
-        )
+    apiurl = "%s&start-timestamp=%s&end-timestamp=%s&api-signature=%s&t=%s" % (
+        get_base_url("historic", parameters["station-id"], parameters["api-key"]),
+        parameters["start-timestamp"],
+        parameters["end-timestamp"],
+        api_signature,
+        parameters["t"],
     )
     return apiurl
 
@@ -172,126 +265,144 @@ def get_historical_url(parameters, api_secret):
 def get_current_url(parameters, api_secret):
     """Construct a valid v2 current API URL"""
 
-    # Remove parameters the current API does not require
-    parameters.pop("start-timestamp", None)
-    parameters.pop("end-timestamp", None)
-    urltext = ""
-    for key in parameters:
-        urltext = urltext + key + str(parameters[key])
-    api_signature = hmac.new(
-        api_secret.encode("utf-8"), urltext.encode("utf-8"), hashlib.sha256
-    ).hexdigest()
-    apiurl = (
-        "https://api.weatherlink.com/v2/current/%s?api-key=%s&api-signature=%s&t=%s"
-        % (
-            parameters["station-id"],
-            parameters["api-key"],
-            api_signature,
-            parameters["t"],
-        )
+    api_signature = get_signature(parameters, _CURRENT_PARAMETERS, api_secret)
+    apiurl = "%s&api-signature=%s&t=%s" % (
+        get_base_url("current", parameters["station-id"], parameters["api-key"]),
+        api_signature,
+        parameters["t"],
     )
     return apiurl
 
 
+# All API calls share one session so the TLS connection to the WeatherLink
+# API is kept alive and reused instead of being set up for every request
+_session = requests.Session()
+_session.headers.update({"Accept": "application/json"})
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=2,
+        max_retries=Retry(total=2, backoff_factor=0.3),
+    ),
+)
+
+
+# Query, ETag and decoded data of the last response from each API endpoint.
+# If the API sent an ETag, the next request for the same query asks it to
+# answer 304 Not Modified instead of sending the same data again. The query
+# leaves out api-signature and t, which the URLs end with and which change on
+# every request, but keeps the historic window, so a 304 for one window is
+# never answered with the data of another.
+_last_responses = dict()
+
+
 def get_json(url):
     """Retrieve JSON data from the API"""
 
+    endpoint = url.split("?", 1)[0]
+    query = url.split("&api-signature=", 1)[0]
+    last_response = _last_responses.get(endpoint)
+    if last_response is not None and last_response[0] != query:
+        last_response = None
+    headers = None
+    if last_response is not None:
+        headers = {"If-None-Match": last_response[1]}
+
+    start = time.perf_counter()
     try:
-        response = requests.get(url)
+        response = _session.get(url, headers=headers, timeout=(5, 15))
     except requests.Timeout as error:
         logerr("Message: %s" % error)
+        return dict()
     except requests.RequestException as error:
         logerr("RequestException: %s" % error)
+        return dict()
+    fetched = time.perf_counter()
 
-    return response.json()
+    if response.status_code == 304 and last_response is not None:
+        logdbg("API data from %s not modified", endpoint)
+        return last_response[2]
 
+    try:
+        data = json_loads(response.content)
+    except ValueError as error:
+        logerr("Invalid JSON received from API: %s" % error)
+        return dict()
+    etag = response.headers.get("ETag")
+    if etag:
+        _last_responses[endpoint] = (query, etag, data)
+    else:
+        _last_responses.pop(endpoint, None)
+    logdbg(
+        "API request took %.3f s, JSON decode took %.6f s",
+        fetched - start,
+        time.perf_counter() - fetched,
+    )
+    return data
 
-def decode_historical_json(data):
-    """Read the historical API JSON data"""
 
-    h_packet = dict()
-    try:
-        historical_data = data["sensors"]
-        for i in range(7):
-            if historical_data[i]["data"] and (
-                historical_data[i]["data_structure_type"] == 11
-                or historical_data[i]["data_structure_type"] == 13
-            ):
-                logdbg("Found historical data from data ID %s" % i)
-                values = historical_data[i]["data"][0]
-
-                h_packet["rxCheckPercent"] = values.get("reception")
-                h_packet["rssi"] = values.get("rssi")
-                h_packet["supercapVolt"] = values.get("supercap_volt_last")
-                h_packet["solarVolt"] = values.get("solar_volt_last")
-                h_packet["packetStreak"] = values.get("good_packets_streak")
-                h_packet["txID"] = values.get("tx_id")
-                h_packet["txBattery"] = values.get("trans_battery")
-                h_packet["rainfallClicks"] = values.get("rainfall_clicks")
-                h_packet["solarRadVolt"] = values.get("solar_rad_volt_last")
-                h_packet["txBatteryFlag"] = values.get("trans_battery_flag")
-                h_packet["signalQuality"] = values.get("reception")
-                h_packet["errorPackets"] = values.get("error_packets")
-                h_packet["afc"] = values.get("afc")
-                h_packet["resynchs"] = values.get("resynchs")
-                h_packet["uvVolt"] = values.get("uv_volt_last")
-
-                break
-    except KeyError as error:
+def get_sensor_data(data):
+    """Index the first data record of each sensor by data structure type, or
+    return None if the API data has no sensor list"""
+
+    sensors = data.get("sensors")
+    if sensors is None:
+        return None
+    sensor_data = dict()
+    for sensor in sensors:
+        values = sensor.get("data")
+        if values:
+            sensor_data.setdefault(sensor.get("data_structure_type"), values[0])
+    return sensor_data
+
+
+def decode_historical_json(data, packet):
+    """Read the historical API JSON data into packet"""
+
+    sensor_data = get_sensor_data(data)
+    if sensor_data is None:
         logerr(
             "No valid historical  API data recieved. Double-check API "
-            "key/secret and station id. Error is: %s" % error
+            "key/secret and station id. No sensors found in API data."
         )
         logerr("The API data returned was: %s" % data)
-    except IndexError as error:
-        logerr(
-            "No valid historical data structure types found in API data. "
-            "Error is: %s" % error
-        )
+        return
+
+    for data_type in _HISTORICAL_DATA_TYPES:
+        values = sensor_data.get(data_type)
+        if values is not None:
+            logdbg("Found historical data with data structure type %s", data_type)
+            get_value = values.get
+            packet.update(
+                (field, get_value(source)) for field, source in _HISTORICAL_FIELDS
+            )
+            break
+    else:
+        logerr("No valid historical data structure types found in API data.")
         logerr("The API data returned was: %s" % data)
-    return h_packet
 
 
-def decode_current_json(data):
-    """Read the current API JSON data"""
+def decode_current_json(data, packet):
+    """Read the current API JSON data into packet"""
 
-    c_packet = dict()
-    try:
-        current_data = data["sensors"]
-        for i in range(7):
-            if current_data[i]["data"] and current_data[i]["data_structure_type"] == 15:
-                logdbg("Found current data from data ID %s" % i)
-                values = current_data[i]["data"][0]
-
-                c_packet["consoleBattery"] = values.get("battery_voltage")
-                c_packet["rapidRecords"] = values.get("rapid_records_sent")
-                c_packet["firmwareVersion"] = values.get("firmware_version")
-                c_packet["uptime"] = values.get("uptime")
-                c_packet["touchpadWakeups"] = values.get("touchpad_wakeups")
-                c_packet["bootloaderVersion"] = values.get("bootloader_version")
-                c_packet["localAPIQueries"] = values.get("local_api_queries")
-                c_packet["rxBytes"] = values.get("rx_bytes")
-                c_packet["healthVersion"] = values.get("health_version")
-                c_packet["radioVersion"] = values.get("radio_version")
-                c_packet["espressIFVersion"] = values.get("espressif_version")
-                c_packet["linkUptime"] = values.get("link_uptime")
-                c_packet["consolePower"] = values.get("input_voltage")
-                c_packet["txBytes"] = values.get("tx_bytes")
-
-                break
-    except KeyError as error:
+    sensor_data = get_sensor_data(data)
+    if sensor_data is None:
         logerr(
             "No valid current API data recieved. Double-check API "
-            "key/secret and station id. Error is: %s" % error
+            "key/secret and station id. No sensors found in API data."
         )
         logerr("The API data returned was: %s" % data)
-    except IndexError as error:
-        logerr(
-            "No valid current data structure types found in API data. "
-            "Error is: %s" % error
-        )
+        return
+
+    values = sensor_data.get(_CURRENT_DATA_TYPE)
+    if values is not None:
+        logdbg("Found current data with data structure type %s", _CURRENT_DATA_TYPE)
+        get_value = values.get
+        packet.update((field, get_value(source)) for field, source in _CURRENT_FIELDS)
+    else:
+        logerr("No valid current data structure types found in API data.")
         logerr("The API data returned was: %s" % data)
-    return c_packet
 
 
 class DavisHealthAPI(StdService):
@@ -316,65 +427,84 @@ class DavisHealthAPI(StdService):
         )
 
         # be sure schema in database matches the schema we have
-        dbcol = self.dbm.connection.columnsOf(self.dbm.table_name)
-        dbm_dict = weewx.manager.get_manager_dict(
-            config_dict["DataBindings"], config_dict["Databases"], binding
-        )
-        memcol = [x[0] for x in dbm_dict["schema"]]
-        if dbcol != memcol:
+        dbcol = tuple(self.dbm.connection.columnsOf(self.dbm.table_name))
+        if dbcol != _SCHEMA_COLUMNS:
             raise Exception(
-                "davishealthapi schema mismatch: %s != %s" % (dbcol, memcol)
+                "davishealthapi schema mismatch: %s != %s" % (dbcol, _SCHEMA_COLUMNS)
             )
 
+        # sqlite databases need some help to stay small. Let pruned pages be
+        # released incrementally instead of vacuuming the whole file each time.
+        # auto_vacuum only applies to an existing database after the next full
+        # vacuum, which the first prune that removes records runs.
+        self.last_prune_ts = 0
+        self.last_vacuum_ts = 0
+        self.prune_sql = "delete from %s where dateTime < ?" % self.dbm.table_name
+        try:
+            self.dbm.getSql("PRAGMA auto_vacuum=INCREMENTAL")
+            self.dbm.getSql("PRAGMA journal_mode=WAL")
+            self.dbm.getSql("PRAGMA synchronous=NORMAL")
+        except Exception as error:
+            logdbg("Could not set sqlite pragmas: %s", error)
+
         self.last_ts = None
+        self.last_poll_record_ts = None
         self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
 
     @staticmethod
     def get_data(api_key, api_secret, station_id, polling_interval):
         """Make an API call and process the data"""
-        packet = dict()
-        packet["dateTime"] = int(time.time())
-        packet["usUnits"] = weewx.US
-
         if not api_key or not station_id or not api_secret:
             logerr(
                 "DavisHealthAPI is missing a required parameter. "
                 "Double-check your configuration file. key: %s"
                 "secret: %s station ID: %s" % (api_key, api_secret, station_id)
             )
-            return packet
+            # The record is still saved, so it needs a timestamp and units
+            return {"dateTime": int(time.time()), "usUnits": weewx.US}
 
-        # WL API expects all of the components of the API call to be in
-        # alphabetical order before the signature is calculated
+        # Read the clock once so the stored timestamp and every signed
+        # timestamp agree, even if the second rolls over part way through
+        now = int(time.time())
+        packet = dict()
+        packet["dateTime"] = now
+        packet["usUnits"] = weewx.US
+
+        # The URL builders only sign and send the parameters their endpoint
+        # takes, in the alphabetical order the WL API expects, so both can
+        # share one set
         parameters = {
             "api-key": api_key,
-            "end-timestamp": int(time.time()),
-            "start-timestamp": int(time.time() - polling_interval),
+            "end-timestamp": now,
+            "start-timestamp": int(now - polling_interval),
             "station-id": station_id,
-            "t": int(time.time()),
+            "t": now,
         }
 
-        url = get_historical_url(parameters, api_secret)
-        logdbg("Historical data url is %s" % url)
-        data = get_json(url)
-        h_packet = decode_historical_json(data)
-
-        url = get_current_url(parameters, api_secret)
-        logdbg("Current data url is %s" % url)
-        data = get_json(url)
-        c_packet = decode_current_json(data)
-
-        packet.update(h_packet)
-        packet.update(c_packet)
+        start = time.perf_counter()
+        historical_url = get_historical_url(parameters, api_secret)
+        current_url = get_current_url(parameters, api_secret)
+        logdbg("Building API URLs took %.6f s", time.perf_counter() - start)
+        logdbg("Historical data url is %s", historical_url)
+        logdbg("Current data url is %s", current_url)
+
+        # The two API calls don't depend on each other, so make them at the
+        # same time rather than waiting for one before starting the other
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            historical_data = executor.submit(get_json, historical_url)
+            current_data = executor.submit(get_json, current_url)
+            decode_historical_json(historical_data.result(), packet)
+            decode_current_json(current_data.result(), packet)
 
         return packet
 
     def shutDown(self):
-        """close database"""
+        """close database and API connections"""
         try:
             self.dbm.close()
         except Exception as error:
             logerr("Database exception: %s" % error)
+        _session.close()
 
     def new_archive_record(self, event):
         """save data to database then prune old records as needed"""
@@ -384,25 +514,57 @@ class DavisHealthAPI(StdService):
         if delta > event.record["interval"] * 60:
             loginf("Skipping record: time difference %s too big" % delta)
             return
+        # Don't poll the API again if records arrive faster than the archive
+        # interval. Archive timestamps land on interval boundaries, so compare
+        # those rather than when the handler happened to run, and allow half an
+        # interval of slack.
+        record_ts = event.record["dateTime"]
+        if self.last_poll_record_ts is not None:
+            since_poll = record_ts - self.last_poll_record_ts
+            if since_poll < event.record["interval"] * 60 / 2:
+                logdbg("Skipping record: last API poll was %s seconds ago", since_poll)
+                return
         if self.last_ts is not None:
             self.save_data(self.get_packet(now, self.last_ts))
+            self.last_poll_record_ts = record_ts
         self.last_ts = now
-        if self.max_age is not None:
+        if self.max_age is not None and now - self.last_prune_ts >= PRUNE_INTERVAL:
             self.prune_data(now - self.max_age)
+            self.last_prune_ts = now
 
     def save_data(self, record):
         """save data to database"""
+        start = time.perf_counter()
         self.dbm.addRecord(record)
+        logdbg("Database write took %.3f s", time.perf_counter() - start)
 
     def prune_data(self, timestamp):
         """delete records with dateTime older than ts"""
-        sql = "delete from %s where dateTime < %d" % (self.dbm.table_name, timestamp)
-        self.dbm.getSql(sql)
+        start = time.perf_counter()
+        # Nothing to do if even the oldest record is new enough to keep
+        oldest_ts = self.dbm.firstGoodStamp()
+        if oldest_ts is None or oldest_ts >= timestamp:
+            return
+        with weedb.Transaction(self.dbm.connection) as cursor:
+            cursor.execute(self.prune_sql, (timestamp,))
         try:
-            # sqlite databases need some help to stay small
-            self.dbm.getSql("vacuum")
+            # sqlite databases need some help to stay small. Only rewrite the
+            # whole file once in a while and otherwise just release free pages.
+            now = int(time.time())
+            if now - self.last_vacuum_ts >= VACUUM_INTERVAL:
+                self.dbm.getSql("vacuum")
+                self.last_vacuum_ts = now
+            else:
+                # incremental_vacuum frees one page each time it is stepped,
+                # but returns no rows, so a cursor only ever steps it once.
+                # executescript on the underlying sqlite3 connection runs it
+                # to completion.
+                self.dbm.connection.connection.executescript(
+                    "PRAGMA incremental_vacuum(1000);"
+                )
         except Exception as error:
             logerr("Prune data error: %s" % error)
+        logdbg("Database prune took %.3f s", time.perf_counter() - start)
 
     def get_packet(self, now_ts, last_ts):
         """Retrieves and assembles the final packet"""
@@ -411,5 +573,5 @@ class DavisHealthAPI(StdService):
         )
         # calculate the interval (an integer), and be sure it is non-zero
         record["interval"] = max(1, int((now_ts - last_ts) / 60))
-        logdbg("davishealthapi packet: %s" % record)
+        logdbg("davishealthapi packet: %s", record)
         return record
@@ -1,4 +1,3 @@
-import collections
 import hashlib
 import hmac
 import time
@@ -30,10 +29,10 @@ the hashing algorithm.
 """
 First we need to sort the paramters in ASCII order by the key.
 The parameter names are all in US English so basic ASCII sorting is
-safe. We will use an ordered dictionary to help keep the
-parameters sorted.
+safe. Dictionaries keep their insertion order, so building a new
+one from the sorted items keeps the parameters sorted.
 """
-parameters = collections.OrderedDict(sorted(parameters.items()))
+parameters = dict(sorted(parameters.items()))
 
 """
 Let's take a moment to print out all parameters for debugging
@@ -52,9 +51,7 @@ parameters.pop("api-secret", None)
 Iterate over the remaining sorted parameters and concatenate
 the parameter names and values into a single string.
 """
-data = ""
-for key in parameters:
-    data = data + key + str(parameters[key])
+data = "".join(key + str(value) for key, value in parameters.items())
 
 """
 Let's print out the data we are going to hash.